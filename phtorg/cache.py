@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import logging
+from pathlib import Path
+
+
+log = logging.getLogger(__name__)
+
+# One connection per database per process (workers each open their own)
+_connections: dict[Path, sqlite3.Connection] = {}
+# Databases that failed in this process; the cache is skipped for them from then on
+_broken: set[Path] = set()
+
+
+def default_cache_path() -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(cache_home) / 'phtorg' / 'hashes.sqlite3'
+
+
+class HashCache:
+    '''Persistent file digests keyed by (device, inode, size, mtime) and hash mode.
+
+    Renaming a file keeps all of these, so files that were already organized
+    are not re-hashed on the next run. Only the path is stored on the
+    instance, so it can be pickled into worker processes cheaply.
+
+    The cache never fails a file: on any database error it is skipped and
+    the digest is computed as usual.
+    '''
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit; several workers may write at once
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, digest TEXT NOT NULL)')
+        return conn
+
+    def check(self) -> bool:
+        '''Open the database once to see if it is usable (without keeping the connection around to be forked)'''
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('SELECT 1 FROM hashes LIMIT 1').fetchall()
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            log.warning(f'Hash cache {self.path} is not usable, hashing everything: {e!r}')
+            return False
+        return True
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if (conn := _connections.get(self.path)) is None:
+            conn = _connections[self.path] = self._connect()
+        return conn
+
+    @staticmethod
+    def _key(st: os.stat_result, mode: str) -> str:
+        # TEXT rather than INTEGER columns: inode numbers may not fit in SQLite's int64
+        return f'{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{mode}'
+
+    def _disable(self, e: Exception) -> None:
+        log.warning(f'Hash cache {self.path} failed, skipping it in this process: {e!r}')
+        _broken.add(self.path)
+
+    def get(self, st: os.stat_result, mode: str) -> str | None:
+        if self.path in _broken:
+            return None
+        try:
+            row = self.conn.execute('SELECT digest FROM hashes WHERE key = ?', (self._key(st, mode),)).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            self._disable(e)
+            return None
+        return row[0] if row else None
+
+    def put(self, st: os.stat_result, mode: str, digest: str) -> None:
+        if self.path in _broken:
+            return
+        try:
+            self.conn.execute('INSERT OR REPLACE INTO hashes (key, digest) VALUES (?, ?)', (self._key(st, mode), digest))
+        except (sqlite3.Error, OSError) as e:
+            self._disable(e)
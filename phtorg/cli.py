@@ -1,10 +1,14 @@
 import itertools
+import importlib.util
 from pathlib import Path
 
 import click
 import tzlocal
 from tabulate import tabulate
+from phtorg import constants
 from phtorg.tpe import tpe_submit
+from phtorg.cache import HashCache
+from phtorg.cache import default_cache_path
 from phtorg.logging import setup_logging
 from phtorg.organizer import PhotoInfo
 from phtorg.organizer import PhotoOrganizer
@@ -24,11 +28,20 @@ def cli(ctx, timezone: str, allow_mtime: bool):
 @cli.command()
 @click.argument('src_dir', type=click.Path(exists=True, path_type=Path))
 @click.option('-d', '--dst-dir', type=click.Path(path_type=Path), default=Path('.'), help='Destination directory')
+@click.option('--hasher', type=click.Choice(constants.HASHERS), default=constants.DEFAULT_HASHER, show_default=True, help='Hash algorithm for the filename suffix (changing it changes every filename)')
+@click.option('--quick-hash', is_flag=True, help='Only hash the size, head and tail of each file (much faster for large videos, but gives different filenames)')
+@click.option('--no-hash-cache', is_flag=True, help='Do not read or write the persistent hash cache')
 @click.pass_obj
-def organize(obj: dict, src_dir: Path, dst_dir: Path):
+def organize(obj: dict, src_dir: Path, dst_dir: Path, hasher: str, quick_hash: bool, no_hash_cache: bool):
     '''Organize photos/videos into folders'''
+    if hasher == 'blake3' and importlib.util.find_spec('blake3') is None:
+        raise click.BadParameter('requires the `blake3` package (pip install "phtorg[blake3]")', param_hint='--hasher')
     org = PhotoOrganizer(src_dir, dst_dir, obj['timezone'])
     org.allow_mtime = obj['allow_mtime']
+    org.hasher = hasher
+    org.quick_hash = quick_hash
+    if not no_hash_cache:
+        org.hash_cache = HashCache(default_cache_path())
     org.start()
 
 
@@ -59,4 +72,6 @@ def analyze(obj: dict, src_dir: Path, datetime_source: tuple[str], only_errors:
     failed_infos = (PhotoInfo.no_datetime(p, repr(e)) for p, e in failed)
     infos = itertools.chain(infos, failed_infos)
 
-    click.echo_via_pager(tabulate(sorted(infos), headers=['path', 'datetime', 'datetime_source', 'errors']))
+    # Each path appears once, so a key sort matches the dataclass order without its per-compare tuples
+    infos = sorted(infos, key=lambda i: i.path)
+    click.echo_via_pager(tabulate(infos, headers=['path', 'datetime', 'datetime_source', 'errors']))
@@ -8,3 +8,12 @@
 
 DEFAULT_PREFIX = 'IMG_'
 DATETIME_FMT = '%Y%m%d_%H%M%S'
+
+# Hash algorithm used for the {hash} part. Changing it changes every filename,
+# so stick to the default unless you are starting a fresh archive.
+DEFAULT_HASHER = 'sha1'
+HASHERS = ('sha1', 'sha256', 'blake3')
+
+# With --quick-hash, only the file size and this many bytes from the head
+# and the tail of the file are hashed.
+QUICK_HASH_SAMPLE = 1024 * 1024  # 1 MiB
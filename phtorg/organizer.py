@@ -1,20 +1,29 @@
 #!/usr/bin/env python
 
+import os
+import sys
 import re
 import io
 import csv
+import errno
+import mmap
 import hashlib
+import concurrent.futures
 import logging
+import multiprocessing
 import dataclasses
 from pathlib import Path
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from collections.abc import Iterable
+from zoneinfo import ZoneInfo
 
-import pytz
 import click
 from tqdm import tqdm
 from PIL import Image
 from PIL import ExifTags
+from PIL import UnidentifiedImageError
 from pillow_heif import register_heif_opener
 from pymediainfo import MediaInfo
 from tabulate import tabulate
@@ -22,6 +31,7 @@ from dateutil.parser import isoparse
 
 from phtorg import constants
 from phtorg.tpe import tpe_submit
+from phtorg.cache import HashCache
 
 
 register_heif_opener()
@@ -42,11 +52,8 @@ class PhotoInfo:
     def header() -> list[str]:
         return ['src', 'errors']
 
-    def row(self) -> dict:
-        return {
-            'src': str(self.path),
-            'errors': '; '.join(self.errors),
-        }
+    def row_tuple(self) -> tuple[str, str]:
+        return (str(self.path), '; '.join(self.errors))
 
     @classmethod
     def no_datetime(cls, path: Path, error: str):
@@ -65,36 +72,37 @@ class RenameTask:
     def header() -> list[str]:
         return ['src', 'datetime', 'datetime_source', 'dst']
 
-    def row(self) -> dict:
-        return {
-            'src': str(self.photo_info.path),
-            'datetime': str(self.photo_info.datetime),
-            'datetime_source': self.photo_info.datetime_source,
-            'dst': str(self.destination),
-        }
+    def row_tuple(self) -> tuple[str, str, str | None, str]:
+        return (str(self.photo_info.path), str(self.photo_info.datetime), self.photo_info.datetime_source, str(self.destination))
 
 
 class PhotoOrganizer:
 
-    pillow_exts = {'.jpg', '.jpeg', '.heic'}
+    pillow_formats = {'.jpg': ('JPEG',), '.jpeg': ('JPEG',), '.heic': ('HEIF',)}
+    pillow_exts = set(pillow_formats)
     mediainfo_exts = {'.mov', '.mp4', '.m4v'}
     screenshot_exts = {'.png', '.gif', '.bmp', '.webp'}
     allowed_exts = pillow_exts | mediainfo_exts | screenshot_exts
+    # EXIF tag IDs we care about, in order of preference
+    exif_datetime_tags = (ExifTags.Base.DateTimeOriginal, ExifTags.Base.DateTimeDigitized, ExifTags.Base.DateTime)
+    exif_offset_tags = (ExifTags.Base.OffsetTimeOriginal, ExifTags.Base.OffsetTimeDigitized, ExifTags.Base.OffsetTime)
     allow_mtime = False
+    hasher = constants.DEFAULT_HASHER
+    quick_hash = False
+    hash_cache: HashCache | None = None
 
     def __init__(self, src_dir: Path, dst_dir: Path, timezone_name: str) -> None:
         self.src_dir = src_dir
         self.dst_dir = dst_dir
         self.rename_tasks: list[RenameTask] = []
         self.skipped_items: list[PhotoInfo] = []
-        self.timezone = pytz.timezone(timezone_name)
+        self._stat_cache: dict[Path, os.stat_result | None] = {}
+        self.timezone = ZoneInfo(timezone_name)
 
     def get_info(self, photo: Path) -> PhotoInfo:
         ext = photo.suffix.lower()
-        if ext in self.pillow_exts:
-            info = self.get_info_from_pillow(photo)
-        elif ext in self.mediainfo_exts:
-            info = self.get_info_from_mediainfo(photo)
+        if handler := self.ext_handlers.get(ext):
+            info = handler(self, photo)
         elif ext in self.screenshot_exts:
             info = PhotoInfo.no_datetime(photo, 'Datetime extraction is skipped for this type of file')
         else:
@@ -109,7 +117,7 @@ class PhotoOrganizer:
             # Validate timezone
             tzinfo = info.datetime.tzinfo
             assert tzinfo is not None, 'timezone does not exist'
-            assert str(tzinfo) == str(self.timezone), 'timezone does not match'
+            assert tzinfo is self.timezone, 'timezone does not match'
 
         return info
 
@@ -117,9 +125,11 @@ class PhotoOrganizer:
         if self.src_dir.is_file():
             yield self.src_dir
         else:
-            for p in self.src_dir.rglob('*.*'):
-                if p.suffix.lower() in self.allowed_exts:
-                    yield p
+            # os.walk is scandir-based and yields as it goes, unlike sorted(rglob())
+            for dirpath, _, filenames in os.walk(self.src_dir):
+                for filename in filenames:
+                    if os.path.splitext(filename)[1].lower() in self.allowed_exts:
+                        yield Path(dirpath, filename)
 
     def parse_timestamp(self, ts: int | float) -> datetime:
         '''Parse Unix timestamp into an aware datetime'''
@@ -130,26 +140,28 @@ class PhotoOrganizer:
         return PhotoInfo(photo, dt, 'mtime')
 
     def get_info_from_pillow(self, photo: Path) -> PhotoInfo:
-        image = Image.open(photo)
-        _exif1 = image.getexif()
-        _exif2 = _exif1.get_ifd(0x8769)
-        _exif = dict(_exif1) | _exif2
-        exif = {
-            ExifTags.TAGS[k]: v
-            for k, v in _exif.items()
-            if k in ExifTags.TAGS and type(v) is not bytes
-        }
+        # Skip probing every registered plugin for the common case,
+        # but still let mislabelled files (e.g. PNG saved as .jpg) through.
+        try:
+            image = Image.open(photo, formats=self.pillow_formats[photo.suffix.lower()])
+        except UnidentifiedImageError:
+            image = Image.open(photo)
+        with image:
+            _exif1 = image.getexif()
+            _exif2 = _exif1.get_ifd(ExifTags.IFD.Exif)
+        # Exif IFD takes precedence over IFD0
+        ifds = (_exif2, _exif1)
 
         # No EXIF at all
-        if not exif:
+        if not _exif1 and not _exif2:
             return PhotoInfo.no_datetime(photo, 'File is EXIF-compatible but no EXIF found')
 
         # Extract datetime and offset from EXIF
         # EXIF 2.31 (July 2016) introduced "OffsetTime", "OffsetTimeOriginal" and "OffsetTimeDigitized".
         # They are formatted as seven ASCII characters (including the null terminator) denoting
         # the hours and minutes of the offset, like +01:00 or -01:00.
-        _exif_dt = exif.get('DateTimeOriginal') or exif.get('DateTimeDigitized') or exif.get('DateTime')
-        _exif_time_offset = exif.get('OffsetTimeOriginal') or exif.get('OffsetTimeDigitized') or exif.get('OffsetTime')
+        _exif_dt = self._get_exif_str(ifds, self.exif_datetime_tags)
+        _exif_time_offset = self._get_exif_str(ifds, self.exif_offset_tags)
         # If not conform to standard, treat it as garbage.
         if _exif_time_offset is not None and not re.match(r'[+-]\d\d\:\d\d', _exif_time_offset):
             _exif_time_offset = ''
@@ -161,16 +173,35 @@ class PhotoOrganizer:
         # Parse datetime string
         # Some software appends non-ASCII bytes like '下午'
         # 'DateTime': '2018:12:25 18:19:37ä¸\x8bå\x8d\x88'
-        dt_str = _exif_dt[:19].replace(':', '-', 2)
+        # The format is fixed ("YYYY:MM:DD HH:MM:SS"), so slice it instead of going through isoparse
+        s = _exif_dt
+        dt = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
         if _exif_time_offset:
-            dt_str += _exif_time_offset
-            dt = isoparse(dt_str).astimezone(self.timezone)
+            offset = timedelta(hours=int(_exif_time_offset[1:3]), minutes=int(_exif_time_offset[4:6]))
+            if _exif_time_offset[0] == '-':
+                offset = -offset
+            dt = dt.replace(tzinfo=timezone(offset)).astimezone(self.timezone)
         else:
-            dt = self.timezone.localize(isoparse(dt_str))
+            dt = dt.replace(tzinfo=self.timezone)
+            # Like pytz's localize(is_dst=False), use standard time for both repeated
+            # (fall back) and skipped (spring forward) wall times: fold=1 for the
+            # former, the default fold=0 already does it for the latter
+            if dt.dst() and not dt.replace(fold=1).dst():
+                dt = dt.replace(fold=1)
         return PhotoInfo(photo, dt, 'EXIF')
 
+    @staticmethod
+    def _get_exif_str(ifds: Iterable[dict], tags: Iterable[int]) -> str | None:
+        '''Return the first non-empty string value of `tags` (in order of preference) found in `ifds`'''
+        for tag in tags:
+            for ifd in ifds:
+                if (value := ifd.get(tag)) and isinstance(value, str):
+                    return value
+        return None
+
     def get_info_from_mediainfo(self, photo: Path) -> PhotoInfo:
-        mediainfo = MediaInfo.parse(photo)
+        # Only the general track's dates are needed: skip full output and deep stream analysis
+        mediainfo = MediaInfo.parse(photo, parse_speed=0, full=False)
         general_track = mediainfo.general_tracks[0]  # type: ignore
         if dt_str := general_track.comapplequicktimecreationdate:
             # com.apple.quicktime.creationdate         : 2018-10-08T21:24:34-0700
@@ -187,45 +218,115 @@ class PhotoOrganizer:
             local_dt = dt.astimezone(self.timezone)
         # If dt is naive, assume it's UTC
         else:
-            local_dt = pytz.utc.localize(dt).astimezone(self.timezone)
+            local_dt = dt.replace(tzinfo=timezone.utc).astimezone(self.timezone)
         return PhotoInfo(photo, local_dt, 'MediaInfo')
 
+    # Extension -> datetime extractor, so get_info does one dict lookup per file
+    ext_handlers = {
+        **dict.fromkeys(pillow_exts, get_info_from_pillow),
+        **dict.fromkeys(mediainfo_exts, get_info_from_mediainfo),
+    }
+
     def start(self):
+        if self.hash_cache is not None and not self.hash_cache.check():
+            self.hash_cache = None
         self._prepare_rename_tasks(self.iter_photo())
-        self.rename_tasks = sorted(self.rename_tasks)
-        self.skipped_items = sorted(self.skipped_items)
+        # Each source path appears once, so sorting by path gives the dataclass
+        # order without building field tuples on every comparison
+        self.rename_tasks.sort(key=lambda t: t.photo_info.path)
+        self.skipped_items.sort(key=lambda i: i.path)
         log.info(f'Collected {len(self.rename_tasks)} rename tasks.')
         log.info(f'Collected {len(self.skipped_items)} skipped items.')
         self._confirm_rename()
 
     @staticmethod
-    def get_deterministic_filename(photo: Path, dt: datetime, prefix: str = constants.DEFAULT_PREFIX) -> str:
-        timestamp = dt.strftime(constants.DATETIME_FMT)
-        # Generate a Git-like hash (first 7 chars of SHA-1)
+    def _new_hash(hasher: str):
+        if hasher == 'blake3':
+            try:
+                import blake3
+            except ImportError:
+                raise RuntimeError('The blake3 hasher requires the `blake3` package') from None
+            # Single-threaded (still SIMD): the process pool already runs one hash per core
+            return blake3.blake3()
+        return hashlib.new(hasher)
+
+    @staticmethod
+    def hash_file(photo: Path, hasher: str = constants.DEFAULT_HASHER, quick: bool = False) -> str:
+        '''Return the hex digest of a file (or of its size + head + tail if `quick`)'''
+        # Buffered: BufferedReader.read(n) retries short reads (NFS/FUSE/SMB), keeping quick digests stable
         with open(photo, 'rb') as f:
-            hash_obj = hashlib.sha1()
-            while chunk := f.read(1024 * 1024 * 10):  # 10 MiB
-                hash_obj.update(chunk)
-        h = hash_obj.hexdigest()[:7]
+            return PhotoOrganizer._hash_fileobj(f, hasher, quick)
+
+    @staticmethod
+    def _hash_fileobj(f: io.BufferedReader, hasher: str, quick: bool) -> str:
+        hash_obj = PhotoOrganizer._new_hash(hasher)
+        size = os.fstat(f.fileno()).st_size
+        if quick:
+            # Size + first and last QUICK_HASH_SAMPLE bytes: O(1) I/O regardless of file size
+            sample = constants.QUICK_HASH_SAMPLE
+            hash_obj.update(size.to_bytes(8, 'little'))
+            f.seek(0)
+            hash_obj.update(f.read(sample))
+            if size > sample:
+                f.seek(max(sample, size - sample))
+                hash_obj.update(f.read())
+        # Hash straight from the page cache; mmap cannot map empty files
+        elif size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                hash_obj.update(mm)
+        return hash_obj.hexdigest()
+
+    @staticmethod
+    def get_deterministic_filename(
+        photo: Path, dt: datetime, prefix: str = constants.DEFAULT_PREFIX,
+        hasher: str = constants.DEFAULT_HASHER, quick_hash: bool = False, digest: str | None = None,
+    ) -> str:
+        timestamp = dt.strftime(constants.DATETIME_FMT)
+        # Generate a Git-like hash (first 7 chars of SHA-1 by default)
+        if digest is None:
+            digest = PhotoOrganizer.hash_file(photo, hasher, quick_hash)
+        h = digest[:7]
         fn = f'{prefix}{timestamp}_{h}{photo.suffix.lower()}'
         return fn
 
-    def _get_rename_task(self, photo: Path) -> RenameTask:
+    def get_info_and_hash(self, photo: Path) -> tuple[PhotoInfo, str]:
+        '''get_info() + hash_file(); the digest may come from the hash cache'''
         info = self.get_info(photo)
+        with open(photo, 'rb') as f:
+            return info, self._get_digest(f)
+
+    def _get_digest(self, f: io.BufferedReader) -> str:
+        if self.hash_cache is None:
+            return self._hash_fileobj(f, self.hasher, self.quick_hash)
+        st = os.fstat(f.fileno())
+        # Quick digests depend on the (monkey-patchable) sample size too
+        mode = f'{self.hasher}+quick{constants.QUICK_HASH_SAMPLE}' if self.quick_hash else self.hasher
+        if (digest := self.hash_cache.get(st, mode)) is None:
+            digest = self._hash_fileobj(f, self.hasher, self.quick_hash)
+            self.hash_cache.put(st, mode, digest)
+        return digest
+
+    def _get_rename_task(self, photo: Path) -> RenameTask:
+        info, digest = self.get_info_and_hash(photo)
         assert info.datetime is not None
 
         # Compute filename
-        fn = self.get_deterministic_filename(photo, info.datetime)
+        fn = self.get_deterministic_filename(photo, info.datetime, digest=digest)
 
         full_path = self.dst_dir / str(info.datetime.year) / fn
         rename_task = RenameTask(info, full_path)
         return rename_task
 
     def _prepare_rename_tasks(self, photos: Iterable[Path]) -> None:
-        completed, failed = tpe_submit(self._get_rename_task, sorted(photos))
+        # Hashing and metadata parsing are CPU-bound, so use processes to get around the GIL
+        ppe = concurrent.futures.ProcessPoolExecutor(mp_context=self._get_mp_context())
+        completed, failed = tpe_submit(self._get_rename_task, photos, executor=ppe)
+        self._prefetch_stat(task.destination for _, task in completed)
         for photo, task in completed:
             # Validate
-            if task.destination.exists():
+            if self._stat_cache[task.destination] is not None:
                 # Allow idempotent operations: don't rename a file
                 # if its filename is already what we want
                 if task.destination.samefile(task.photo_info.path):
@@ -239,6 +340,34 @@ class PhotoOrganizer:
             info = PhotoInfo.no_datetime(photo, repr(exception))
             self.skipped_items.append(info)
 
+    @staticmethod
+    def _get_mp_context() -> multiprocessing.context.BaseContext:
+        '''Pick a start method that avoids re-importing Pillow/pillow_heif in every worker'''
+        if sys.platform == 'linux':
+            # Workers inherit the already-registered plugins
+            return multiprocessing.get_context('fork')
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            # fork is unsafe on macOS: import (and register plugins) once in the server instead
+            ctx = multiprocessing.get_context('forkserver')
+            ctx.set_forkserver_preload([__name__])
+            return ctx
+        return multiprocessing.get_context()
+
+    def _prefetch_stat(self, paths: Iterable[Path]) -> None:
+        '''Stat paths concurrently into `_stat_cache` (None if the path does not exist)'''
+        def stat(path: Path) -> os.stat_result | None:
+            try:
+                return os.stat(path)
+            except OSError as e:
+                # Same errors Path.exists() treats as "does not exist"
+                if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP):
+                    return None
+                raise
+
+        paths = list(paths)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=32) as tpe:
+            self._stat_cache.update(zip(paths, tpe.map(stat, paths)))
+
     def _confirm_rename(self) -> None:
         print('Rename the files, preview the tasks, save the tasks in CSV, or abort?')
         try:
@@ -260,27 +389,32 @@ class PhotoOrganizer:
             self._confirm_rename()
 
     def _do_rename(self) -> None:
+        # Most tasks share a handful of year directories; only create each once
+        created_dirs: set[Path] = set()
         for task in tqdm(self.rename_tasks):
-            task.destination.parent.mkdir(parents=True, exist_ok=True)
-            task.photo_info.path.rename(task.destination)
+            parent = task.destination.parent
+            if parent not in created_dirs:
+                os.makedirs(parent, exist_ok=True)
+                created_dirs.add(parent)
+            os.rename(task.photo_info.path, task.destination)
 
     def _preview_tasks(self) -> None:
         text = io.StringIO()
         text.write(f'Rename ({len(self.rename_tasks)}):\n')
-        text.write(tabulate([t.row() for t in self.rename_tasks], headers='keys'))
+        text.write(tabulate([t.row_tuple() for t in self.rename_tasks], headers=RenameTask.header()))
         text.write('\n\n')
         text.write(f'Skip ({len(self.skipped_items)}):\n')
-        text.write(tabulate([i.row() for i in self.skipped_items], headers='keys'))
+        text.write(tabulate([i.row_tuple() for i in self.skipped_items], headers=PhotoInfo.header()))
         text.write('\n\n')
         click.echo_via_pager(text.getvalue())
 
     def _save_tasks(self) -> None:
         with open('rename_tasks.csv', 'w', encoding='utf-8') as f:
-            rename_tasks_csv = csv.DictWriter(f, fieldnames=RenameTask.header())
-            rename_tasks_csv.writeheader()
-            rename_tasks_csv.writerows(t.row() for t in self.rename_tasks)
+            rename_tasks_csv = csv.writer(f)
+            rename_tasks_csv.writerow(RenameTask.header())
+            rename_tasks_csv.writerows(t.row_tuple() for t in self.rename_tasks)
         with open('skipped_items.csv', 'w', encoding='utf-8') as f:
-            skipped_items_csv = csv.DictWriter(f, fieldnames=PhotoInfo.header())
-            skipped_items_csv.writeheader()
-            skipped_items_csv.writerows(i.row() for i in self.skipped_items)
+            skipped_items_csv = csv.writer(f)
+            skipped_items_csv.writerow(PhotoInfo.header())
+            skipped_items_csv.writerows(i.row_tuple() for i in self.skipped_items)
         log.info('Preview of operations written to `rename_tasks.csv` and `skipped_items.csv`')
@@ -1,6 +1,9 @@
+import os
+import itertools
 import concurrent.futures
 from collections.abc import Callable
 from collections.abc import Iterable
+from collections.abc import Sized
 from typing import Any
 from typing import TypeVar
 
@@ -12,38 +15,59 @@ Completed = tuple[T, Any]
 Failed = tuple[T, Exception]
 
 
-def tpe_submit(func: Callable, items: Iterable[T], raise_exception: bool = False) -> tuple[list[Completed], list[Failed]]:
-    '''Run tasks through TPE with a progress bar.'''
+def tpe_submit(
+    func: Callable, items: Iterable[T], raise_exception: bool = False,
+    executor: concurrent.futures.Executor | None = None,
+    max_pending: int | None = None,
+) -> tuple[list[Completed], list[Failed]]:
+    '''Run tasks through TPE (or the given executor) with a progress bar.
+
+    Items are consumed lazily with at most `max_pending` futures in flight,
+    so a generator (e.g. a directory walk) starts feeding workers immediately.
+    '''
     completed: list[Completed] = []
     failed: list[Failed] = []
 
-    tpe = concurrent.futures.ThreadPoolExecutor()
-    futures_map = {
-        tpe.submit(func, item): item
-        for item in items
-    }
-    pending = set(futures_map.keys())
-    pbar = tqdm(total=len(futures_map))
+    tpe = executor or concurrent.futures.ThreadPoolExecutor()
+    if max_pending is None:
+        max_pending = 4 * (os.cpu_count() or 1)
+    items_iter = iter(items)
+    futures_map: dict[concurrent.futures.Future, T] = {}
+    pbar = tqdm(total=len(items) if isinstance(items, Sized) else None)
     try:
-        while pending:
+        while True:
+            # Top up the in-flight futures
+            for item in itertools.islice(items_iter, max_pending - len(futures_map)):
+                try:
+                    futures_map[tpe.submit(func, item)] = item
+                except concurrent.futures.BrokenExecutor as e:
+                    # A worker died and nothing more can run: fail everything not yet submitted
+                    # (in-flight futures already carry the same error)
+                    if raise_exception:
+                        raise
+                    unsubmitted = [item, *items_iter]
+                    failed.extend((i, e) for i in unsubmitted)
+                    pbar.update(len(unsubmitted))
+                    break
+            if not futures_map:
+                break
             # Wait for a few to complete
-            done_now, pending = concurrent.futures.wait(pending, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED)
+            done_now, _ = concurrent.futures.wait(futures_map, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED)
             for future in done_now:
                 pbar.update(1)
+                item = futures_map.pop(future)
                 try:
                     result = future.result()
                 except Exception as e:
                     if raise_exception:
                         raise
-                    item = futures_map[future]
                     failed.append((item, e))
                     continue
                 else:
-                    item = futures_map[future]
                     completed.append((item, result))
     except KeyboardInterrupt:
         tqdm.write('KeyboardInterrupt')
-        tpe.shutdown(wait=False, cancel_futures=True)
     finally:
+        tpe.shutdown(wait=False, cancel_futures=True)
         pbar.close()
-        return completed, failed
+    return completed, failed